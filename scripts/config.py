@@ -3,6 +3,24 @@ import requests
 import json
 from benedict import benedict
 
+def print_response(response):
+	"""Prints response details and body, pretty-printed if JSON"""
+	body = response.content # read once, reused for length and parsing
+	response_type = response.headers.get('Content-Type', '')
+	print(f'Status code: {response.status_code}')
+	print(f'Content type: {response_type}')
+	print(f'Response length: {len(body)}')
+	if ('application/json' in response_type):
+		try:
+			text = json.dumps(json.loads(body), indent=4)
+			print('Response (JSON):')
+			print(text)
+			return
+		except ValueError as e:
+			print(e)
+	print('Response as text')
+	print(response.text)
+
 def main():
 	parser = argparse.ArgumentParser(description='''This script allows to send & retrieve config from the car.''')
 	parser.add_argument('--status', help='Request status before sending/requesting config.', required=False, action='store_true')
@@ -34,26 +52,15 @@ def main():
 			args.ip = '192.168.4.1' # default for ESP32 esp-idf
 			print(f'No config with IP provided, falling back to using default IP: {args.ip}')
 
+	# Reuse single connection (keep-alive) for all the requests
+	session = requests.Session()
+	session.headers['Accept'] = 'application/json'
+
 	try:
 		if args.status:
 			print('--- Status ---')
-			response = requests.get(f'http://{args.ip}/status?detailed=1', timeout=5)
-			response_type = response.headers.get('Content-Type', '')
-			print(f'Status code: {response.status_code}')
-			print(f'Content type: {response_type}')
-			print(f'Response length: {len(response.content)}')
-			if ('application/json' in response_type):
-				try:
-					text = json.dumps(response.json(), indent=4)
-					print('Response (JSON):')
-					print(text)
-				except requests.exceptions.JSONDecodeError as e:
-					print(e)
-					print('Response as text')
-					print(response.text)
-			else:
-				print('Response as text')
-				print(response.text)
+			response = session.get(f'http://{args.ip}/status?detailed=1', timeout=5)
+			print_response(response)
 
 			if args.status_only:
 				exit(0)
@@ -64,26 +71,11 @@ def main():
 
 		if args.read_only or len(target_config) == 0:
 			print('Requesting with GET')
-			response = requests.get(f'http://{args.ip}/config', timeout=5)
+			response = session.get(f'http://{args.ip}/config', timeout=5)
 		else:
 			print('Sending with POST')
-			response = requests.post(f'http://{args.ip}/config', timeout=5, json=target_config)
-		response_type = response.headers.get('Content-Type', '')
-		print(f'Status code: {response.status_code}')
-		print(f'Content type: {response_type}')
-		print(f'Response length: {len(response.content)}')
-		if ('application/json' in response_type):
-			try:
-				text = json.dumps(response.json(), indent=4)
-				print('Response (JSON):')
-				print(text)
-			except requests.exceptions.JSONDecodeError as e:
-				print(e)
-				print('Response as text')
-				print(response.text)
-		else:
-			print('Response as text')
-			print(response.text)
+			response = session.post(f'http://{args.ip}/config', timeout=5, json=target_config)
+		print_response(response)
 
 	except requests.exceptions.ConnectTimeout as e:
 		print(e)
@@ -1,26 +1,274 @@
 import argparse
-import requests
+import ctypes
+import errno
+import http.client
+import json
+import os
+import queue
+import selectors
+import threading
 import time
 import keyboard
 import socket
 import struct
-from math import floor;
+import sys
+from math import floor, copysign;
+
+try:
+	import evdev # optional, Linux only
+except ImportError:
+	evdev = None
+
+# Control packets layouts (little-endian, as on ESP32), see `include/udp.hpp`
+SHORT_CONTROL_PACKET = struct.Struct('<BBBB')
+LONG_CONTROL_PACKET = struct.Struct('<BBHff')
+
+# Number of ticks for which changed state is sent before relying on keep-alive, in case of lost packets
+STATE_CHANGE_REPEAT_TICKS = 3
+
+# Control request body for HTTP `/config` endpoint, without output generated
+HTTP_CONTROL_BODY = b'{"control":{"mainLight":%d,"otherLight":%d,"left":%.2f,"right":%.2f},"silent":1}'
+
+# Keys used by the controls, as bits of single pressed keys mask
+KEY_ESCAPE = 1 << 0
+KEY_SPACE  = 1 << 1
+KEY_SHIFT  = 1 << 2
+KEY_CTRL   = 1 << 3
+KEY_V      = 1 << 4
+KEY_F      = 1 << 5
+KEY_R      = 1 << 6
+KEY_MINUS  = 1 << 7
+KEY_PLUS   = 1 << 8
+KEY_LEFT_BRACKET  = 1 << 9
+KEY_RIGHT_BRACKET = 1 << 10
+KEY_W      = 1 << 11
+KEY_A      = 1 << 12
+KEY_S      = 1 << 13
+KEY_D      = 1 << 14
+KEY_UP     = 1 << 15
+KEY_LEFT   = 1 << 16
+KEY_DOWN   = 1 << 17
+KEY_RIGHT  = 1 << 18
+KEY_Q      = 1 << 19
+KEY_E      = 1 << 20
+
+# Movement in vectorized mode: keys and their contribution to left and right motors
+MOVEMENT_VECTORS = (
+	(KEY_W | KEY_UP,    ( 1.0,  1.0)),
+	(KEY_A | KEY_LEFT,  (-0.5,  0.5)),
+	(KEY_S | KEY_DOWN,  (-1.0, -1.0)),
+	(KEY_D | KEY_RIGHT, ( 0.5, -0.5)),
+	(KEY_Q,             (-1.0,  1.0)),
+	(KEY_E,             ( 1.0, -1.0)),
+)
+
+# Key names as reported by the 'keyboard' library (lowercase, including shifted variants)
+KEYS_BY_NAME = {
+	'esc': KEY_ESCAPE, 'escape': KEY_ESCAPE,
+	'space': KEY_SPACE,
+	'shift': KEY_SHIFT, 'left shift': KEY_SHIFT, 'right shift': KEY_SHIFT,
+	'ctrl': KEY_CTRL, 'left ctrl': KEY_CTRL, 'right ctrl': KEY_CTRL,
+	'v': KEY_V, 'f': KEY_F, 'r': KEY_R,
+	'-': KEY_MINUS, '_': KEY_MINUS,
+	'+': KEY_PLUS, '=': KEY_PLUS,
+	'[': KEY_LEFT_BRACKET, '{': KEY_LEFT_BRACKET,
+	']': KEY_RIGHT_BRACKET, '}': KEY_RIGHT_BRACKET,
+	'w': KEY_W, 'a': KEY_A, 's': KEY_S, 'd': KEY_D,
+	'up': KEY_UP, 'left': KEY_LEFT, 'down': KEY_DOWN, 'right': KEY_RIGHT,
+	'q': KEY_Q, 'e': KEY_E,
+}
+
+# Key codes names as used by `evdev` (Linux input subsystem)
+EVDEV_KEYS_BY_NAME = {
+	'KEY_ESC': KEY_ESCAPE,
+	'KEY_SPACE': KEY_SPACE,
+	'KEY_LEFTSHIFT': KEY_SHIFT, 'KEY_RIGHTSHIFT': KEY_SHIFT,
+	'KEY_LEFTCTRL': KEY_CTRL, 'KEY_RIGHTCTRL': KEY_CTRL,
+	'KEY_V': KEY_V, 'KEY_F': KEY_F, 'KEY_R': KEY_R,
+	'KEY_MINUS': KEY_MINUS, 'KEY_KPMINUS': KEY_MINUS,
+	'KEY_EQUAL': KEY_PLUS, 'KEY_KPPLUS': KEY_PLUS,
+	'KEY_LEFTBRACE': KEY_LEFT_BRACKET,
+	'KEY_RIGHTBRACE': KEY_RIGHT_BRACKET,
+	'KEY_W': KEY_W, 'KEY_A': KEY_A, 'KEY_S': KEY_S, 'KEY_D': KEY_D,
+	'KEY_UP': KEY_UP, 'KEY_LEFT': KEY_LEFT, 'KEY_DOWN': KEY_DOWN, 'KEY_RIGHT': KEY_RIGHT,
+	'KEY_Q': KEY_Q, 'KEY_E': KEY_E,
+}
+EVDEV_KEYS = {evdev.ecodes.ecodes[name]: key for name, key in EVDEV_KEYS_BY_NAME.items()} if evdev else {}
+EVDEV_LOST_DEVICE_ERRNOS = (errno.ENODEV, errno.ENXIO, errno.EIO, errno.EBADF) # errors meaning device is gone
+
+pressed_keys = 0 # mask of currently pressed keys, updated by the keyboard hook or input devices events
+evdev_pressed_keys = {} # masks of keys pressed per `evdev` device path, to release them if device is gone
+
+def map_keyboard_scan_codes():
+	"""Resolves key names used by the controls into scan codes once, as 'keyboard' library reports them in events"""
+	keys_by_scan_code = {}
+	for name, key in KEYS_BY_NAME.items():
+		try:
+			for scan_code in keyboard.key_to_scan_codes(name):
+				keys_by_scan_code.setdefault(scan_code, key)
+		except ValueError: # key not available on current layout
+			pass
+	return keys_by_scan_code
+
+def on_keyboard_event(event, keys_by_scan_code, wake_socket=None):
+	"""Updates pressed keys mask on key events from 'keyboard' library hook, notifying wake socket on change"""
+	global pressed_keys
+	key = keys_by_scan_code.get(event.scan_code)
+	if key is None: # fallback for keys not resolved up front
+		key = KEYS_BY_NAME.get((event.name or '').lower(), 0)
+	previous_keys = pressed_keys
+	if event.event_type == keyboard.KEY_DOWN:
+		pressed_keys |= key
+	else:
+		pressed_keys &= ~key
+	if wake_socket and pressed_keys != previous_keys:
+		try:
+			wake_socket.send(b'\0')
+		except BlockingIOError: # already full of notifications anyway
+			pass
+
+def open_evdev_keyboards():
+	"""Opens input devices which look like keyboards (and we have access to), if `evdev` is available"""
+	if not evdev:
+		return []
+	keyboards = []
+	for path in evdev.list_devices():
+		try:
+			device = evdev.InputDevice(path)
+		except OSError: # no access
+			continue
+		if evdev.ecodes.KEY_W in device.capabilities().get(evdev.ecodes.EV_KEY, []):
+			keyboards.append(device)
+		else:
+			device.close()
+	return keyboards
+
+def read_evdev_events(device, selector):
+	"""Updates pressed keys mask from pending events of `evdev` input device.
+	If device is gone, it's unregistered from the selector and its keys are released."""
+	global pressed_keys
+	device_keys = evdev_pressed_keys.get(device.path, 0)
+	try:
+		for event in device.read():
+			if event.type == evdev.ecodes.EV_KEY:
+				key = EVDEV_KEYS.get(event.code, 0)
+				if event.value: # pressed or held
+					device_keys |= key
+				else:
+					device_keys &= ~key
+				evdev_pressed_keys[device.path] = device_keys
+	except BlockingIOError: # nothing (more) to read, spurious wake up
+		pass
+	except OSError as e:
+		if e.errno not in EVDEV_LOST_DEVICE_ERRNOS:
+			raise
+		print(f'Keyboard lost: {device.name} ({device.path})')
+		selector.unregister(device)
+		device.close()
+		evdev_pressed_keys.pop(device.path, None)
+		if not selector.get_map():
+			print('No keyboards left, all keys released; restart to regain control')
+	# Keys pressed on any of devices, so releasing on one doesn't affect keys still held on another
+	keys = 0
+	for keys_of_device in evdev_pressed_keys.values():
+		keys |= keys_of_device
+	pressed_keys = keys
+
+def wait_for_input(selector, timeout, keys):
+	"""Waits up to given time (in seconds) for pressed keys mask to change from given one.
+	Inputs registered in the selector should have their handler function as data."""
+	deadline = time.monotonic() + timeout
+	while pressed_keys == keys and (remaining := deadline - time.monotonic()) > 0:
+		for selector_key, _ in selector.select(remaining):
+			selector_key.data(selector_key.fileobj)
+
+class iovec(ctypes.Structure):
+	_fields_ = [
+		('iov_base', ctypes.c_void_p),
+		('iov_len', ctypes.c_size_t),
+	]
+
+class msghdr(ctypes.Structure):
+	_fields_ = [
+		('msg_name', ctypes.c_void_p),
+		('msg_namelen', ctypes.c_uint32),
+		('msg_iov', ctypes.POINTER(iovec)),
+		('msg_iovlen', ctypes.c_size_t),
+		('msg_control', ctypes.c_void_p),
+		('msg_controllen', ctypes.c_size_t),
+		('msg_flags', ctypes.c_int),
+	]
+
+class mmsghdr(ctypes.Structure):
+	_fields_ = [
+		('msg_hdr', msghdr),
+		('msg_len', ctypes.c_uint),
+	]
+
+def make_packet_sender(sock, buffer, count):
+	"""Creates function sending the buffer given number of times over connected socket.
+	On Linux, all the copies are sent with single `sendmmsg` syscall.
+	Refused connection errors (reported for connected socket, if earlier packet was refused) are ignored."""
+	send_copies = None
+	if count <= 1:
+		send_copies = lambda: sock.send(buffer)
+	elif sys.platform.startswith('linux'):
+		try:
+			sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+		except (OSError, AttributeError):
+			pass
+		else:
+			# Prepare messages once, all pointing to the same buffer; no address needed as socket is connected
+			iov = iovec(ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer)), len(buffer))
+			messages = (mmsghdr * count)()
+			for message in messages:
+				message.msg_hdr.msg_iov = ctypes.pointer(iov)
+				message.msg_hdr.msg_iovlen = 1
+			fd = sock.fileno()
+			def send_copies():
+				if sendmmsg(fd, messages, count, 0) < 0:
+					error = ctypes.get_errno()
+					raise OSError(error, os.strerror(error))
+	if not send_copies:
+		def send_copies():
+			for _ in range(count):
+				sock.send(buffer)
+
+	def send():
+		try:
+			send_copies()
+		except ConnectionRefusedError: # port unreachable, i.e. car restarting; keep sending as unconnected socket would
+			pass
+	return send
 
 def clamp(value, low, high): 
 	return max(low, min(value, high))
 
+def limit_motor(value, min_speed, max_speed, direction=0):
+	"""Clamps motor duty to max speed, cutting it off to 0 if below min speed,
+	unless speeding up in given direction (then it starts from min speed)"""
+	magnitude = min(abs(value), max_speed)
+	if magnitude >= min_speed:
+		return copysign(magnitude, value)
+	if value * direction > 0:
+		return copysign(min(min_speed, max_speed), value)
+	return 0
+
 def main():
 	parser = argparse.ArgumentParser(
 		description='''This script allows to control the car by continuously reading keyboard inputs and sending packets.''',
-		epilog='''Note: The 'keyboard' library were used (requires sudo under Linux), and it hooks work also out of focus, which is benefit and issue at the same time, so please care.'''
+		epilog='''Note: The 'keyboard' library were used (requires sudo under Linux), and it hooks work also out of focus, which is benefit and issue at the same time, so please care. Under Linux, if 'evdev' package is installed, input devices are read directly instead (requires access to /dev/input, i.e. 'input' group).'''
 	)
 	parser.add_argument('--ip', '--address', help='IP of the device. Default: 192.168.4.1', required=False, default='192.168.4.1')
 	parser.add_argument('--port', help='Port of UDP control server. Default: 83', required=False, default=83, type=int)
 	parser.add_argument('--interval', help='Interval between control packets in milliseconds. Default: 100', required=False, default=100, type=int)
+	parser.add_argument('--keepalive', metavar='INTERVAL', help='Maximal interval between control packets in milliseconds if nothing changes. Default: 500', required=False, default=500, type=int)
+	parser.add_argument('--repeat', metavar='COUNT', help='Number of copies of each control packet to send, for tolerance of lost packets. Default: 1', required=False, default=1, type=int)
 	parser.add_argument('--dry-run', help='Performs dry-run for testing.', required=False, action='store_true')
 	parser.add_argument('--show-packets', help='Show sent packets (like in dry run).', required=False, action='store_true')
 	parser.add_argument('--short-packet-type', help='Uses short packet type instead long.', required=False, action='store_true')
 	parser.add_argument('--no-blink', help='Prevents default behaviour of constant status led blinking.', required=False, action='store_true')
+	parser.add_argument('--blink-interval', metavar='INTERVAL', help='Interval between status led toggles in milliseconds. Default: 500', required=False, default=500, type=int)
 	driving = parser.add_argument_group('Driving model')
 	driving.add_argument('--max-speed', metavar='VALUE', help='Initial maximal speed. From 0.0 for still to 1.0 for full.', required=False, default=1.0, type=float)
 	driving.add_argument('--min-speed', metavar='VALUE', help='Minimal speed to drive motor. Used to avoid motor noises and damage.', required=False, default=0.1, type=float)
@@ -33,82 +281,123 @@ def main():
 	# Testing connection
 	if not args.dry_run:
 		try:
-			response = requests.get(f'http://{args.ip}/status', timeout=5)
-			if not response.ok:
-				print(f'Querying device status failed with status code: {response.status_code}')
+			args.ip = socket.gethostbyname(args.ip) # resolve only once, in case host name is used
+			connection = http.client.HTTPConnection(args.ip, timeout=5) # reused for later HTTP requests
+			connection.request('GET', '/status')
+			response = connection.getresponse()
+			if response.status >= 400:
+				print(f'Querying device status failed with status code: {response.status}')
 				exit(1)
-		except requests.exceptions.ConnectTimeout as e:
+			status = json.loads(response.read())
+			connection.close() # don't hold one of few server sockets while idle, reopened on next request
+		except OSError as e: # including timeouts
 			print(e)
 			exit(1)
 		print('Device found')
 
-		start_time = time.time()
-		start_uptime = int(response.json()['uptime']) # us
+		start_time = time.monotonic()
+		start_uptime = int(status['uptime']) # us
 		start_uptime_ms = round(start_uptime / 1000)
 
 		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
-		# sock.connect((args.ip, args.port))
+		# Small send buffer to rather drop stale controls than queue them, and low latency delivery requested
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024)
+		try:
+			sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, 0x10) # IPTOS_LOWDELAY
+			if hasattr(socket, 'SO_PRIORITY'): # Linux only
+				sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, 6)
+		except OSError: # not supported by some systems, not important
+			pass
+		sock.connect((args.ip, args.port)) # fixed destination, allows using `send` on each tick
 		print('Socket open')
 
+		# Outgoing control packets are packed into the same buffer each time
+		packet_buffer = bytearray((SHORT_CONTROL_PACKET if args.short_packet_type else LONG_CONTROL_PACKET).size)
+		sendPacket = make_packet_sender(sock, packet_buffer, args.repeat)
+
 	max_speed = args.max_speed or 1.0
 	min_speed = args.min_speed or 0.1 # below means cutting off down to 0, avoid weird noises
 	base_gain = args.acceleration or 1 # per second
 	vectorized_mode = True
 
-	left_motor = 0.0 # 0 to 1
+	left_motor = 0.0 # -1 to 1, smoothed (not cut off by min speed)
 	right_motor = 0.0
+	left_duty = 0.0 # -1 to 1, as sent
+	right_duty = 0.0
 	main_light = False
 	other_light = False
 	blink_other_light = not args.no_blink
 
-	def sendControlUDP():
-		"""Sends the UDP packet to control the car"""
-		if args.dry_run:
-			print(f'UDP LM: {left_motor:.3f}, RM: {right_motor:.3f}, ML: {main_light}, OL: {other_light}')
-		else:
-			flags = 0
-			if main_light:
-				flags |= 0b00000001
-			if other_light:
-				flags |= 0b00000010
-			if left_motor < 0:
-				flags |= 0b01000000
-			if right_motor < 0:
-				flags |= 0b01000000
+	# Intervals in seconds
+	interval = args.interval / 1000
+	keepalive_interval = args.keepalive / 1000
+	blink_interval = args.blink_interval / 1000
+
+	def sendControlUDPDryRun():
+		"""Prints the values which would be sent in UDP packet to control the car"""
+		print(f'UDP LM: {left_duty:.3f}, RM: {right_duty:.3f}, ML: {main_light}, OL: {other_light}')
+
+	def sendShortControlUDP():
+		"""Sends the short UDP packet to control the car"""
+		# Flags bits: 0 - main light, 1 - other light, 6 - left backward, 7 - right backward
+		flags = main_light | (other_light << 1) | ((left_duty < 0) << 6) | ((right_duty < 0) << 7)
+		left, right = round(abs(left_duty) * 255), round(abs(right_duty) * 255)
+		SHORT_CONTROL_PACKET.pack_into(packet_buffer, 0, 1, flags, left, right)
+		sendPacket()
+		if args.show_packets:
+			packets_log.put((now, flags, left, right))
+
+	def sendLongControlUDP():
+		"""Sends the long UDP packet to control the car"""
+		flags = main_light | (other_light << 1) | ((left_duty < 0) << 6) | ((right_duty < 0) << 7)
+		left, right = left_duty * 100, right_duty * 100
+		LONG_CONTROL_PACKET.pack_into(packet_buffer, 0, 2, flags, 0, left, right)
+		sendPacket()
+		if args.show_packets:
+			packets_log.put((now, flags, left, right))
+
+	# Packet type and dry-run are fixed, so pick the implementation once instead of checking on each send
+	if args.dry_run:
+		sendControlUDP = sendControlUDPDryRun
+	elif args.short_packet_type:
+		sendControlUDP = sendShortControlUDP
+	else:
+		sendControlUDP = sendLongControlUDP
+
+	# Sent packets are printed by background thread, keeping formatting and console output off the control loop
+	packets_log = queue.SimpleQueue()
+	def printPacketsLog():
+		"""Prints packets sent by `sendControlUDP` (if showing packets), with values as sent, until `None` is queued"""
+		while (packet := packets_log.get()) is not None:
+			sent_time, flags, left, right = packet
+			expected_uptime_ms = start_uptime_ms + floor((sent_time - start_time) * 1000)
 			if args.short_packet_type:
-				bytes = struct.pack('BBBB', 1, flags, round(abs(left_motor) * 255), round(abs(right_motor) * 255))
+				print(f'  ({expected_uptime_ms}) udp: ShortControlPacket: F:{flags:02X} L:{left} R:{right}')
 			else:
-				bytes = struct.pack('BBHff', 2, flags, 0, left_motor * 100, right_motor * 100)
-			sock.sendto(bytes, (args.ip, args.port))
-			if args.show_packets:
-				expected_uptime_ms = start_uptime_ms + floor((time.time() - start_time) * 1000)
-				if args.short_packet_type:
-					print(f'  ({expected_uptime_ms}) udp: ShortControlPacket: F:{flags:02X} T:0ms L:{round(abs(left_motor) * 255) * 100:.2f} R:{round(abs(right_motor) * 255):.3f}')
-				else:
-					print(f'  ({expected_uptime_ms}) udp: LongControlPacket: F:{flags:02X} T:0ms L:{left_motor * 100:.2f} R{right_motor * 100:.2f}')
+				print(f'  ({expected_uptime_ms}) udp: LongControlPacket: F:{flags:02X} T:0ms L:{left:.2f} R:{right:.2f}')
 
 	def sendControlHTTP():
 		"""Sends the HTTP packet to control the car"""
 		if args.dry_run:
-			print(f'HTTP LM: {left_motor:.3f}, RM: {right_motor:.3f}, ML: {main_light}, OL: {other_light}')
+			print(f'HTTP LM: {left_duty:.3f}, RM: {right_duty:.3f}, ML: {main_light}, OL: {other_light}')
 		else:
 			# TODO: actually code control in HTTP server of the car
 			return
-			# Hacky, but simple way to skip waiting for response, see https://stackoverflow.com/a/45601591/4880243
-			try:
-				requests.post(f'http://{args.ip}/config', timeout=0.000001, json={
-					"control": {
-						"mainLight": int(main_light),
-						"otherLight": int(other_light),
-						"left": round(left_motor * 100, 2), 
-						"right": round(right_motor * 100, 2),
-					},
-					"silent": 1 # don't generate output 
-				})
-			except requests.exceptions.ConnectTimeout as e:
-				print(e)
-			except requests.exceptions.ReadTimeout: 
-				pass
+			# Reusing connection (keep-alive). Response is short, as output is silenced.
+			body = HTTP_CONTROL_BODY % (main_light, other_light, left_duty * 100, right_duty * 100)
+			for retry in (True, False):
+				try:
+					connection.request('POST', '/config', body=body, headers={'Content-Type': 'application/json'})
+					connection.getresponse().read() # required before reusing the connection
+					return
+				except ConnectionError as e: # stale connection closed by server (reset, broken pipe, remote disconnected)
+					connection.close() # will reconnect on next request
+					if not retry:
+						print(e)
+				except (OSError, http.client.HTTPException) as e:
+					print(e)
+					connection.close()
+					return
 
 	def controls():
 		"""Prints controls help"""
@@ -120,131 +409,159 @@ def main():
 		print('\t+/- to modify acceleration; [/] to modify max speed;')
 		print('\tShift to temporary uncap speed; ESC to exit.')
 
+	packets_log_thread = None
 	try:
 		controls()
+		# Loop waits for either next tick or keys change, to react without delay
+		selector = selectors.DefaultSelector()
+		keyboards = open_evdev_keyboards()
+		if keyboards:
+			for device in keyboards:
+				print(f'Using keyboard: {device.name} ({device.path})')
+				selector.register(device, selectors.EVENT_READ, lambda device: read_evdev_events(device, selector))
+		else:
+			wake_reader, wake_writer = socket.socketpair()
+			wake_writer.setblocking(False)
+			selector.register(wake_reader, selectors.EVENT_READ, lambda wake_reader: wake_reader.recv(4096))
+			keys_by_scan_code = map_keyboard_scan_codes()
+			keyboard.hook(lambda event: on_keyboard_event(event, keys_by_scan_code, wake_writer))
+		if args.show_packets and not args.dry_run:
+			packets_log_thread = threading.Thread(target=printPacketsLog, daemon=True)
+			packets_log_thread.start()
 		time.sleep(0.500)
 
-		last_update_time = time.time()
+		last_update_time = time.monotonic()
+		last_sent_time = 0
+		last_sent_state = None
+		repeat_ticks = 0
+		last_blink_time = 0
+		previous_keys = 0
 		while True:
-			delta_time = time.time() - last_update_time
-
-			if keyboard.is_pressed('escape'):
+			now = time.monotonic() # single clock read per tick
+			next_tick_time = now + interval # deadline counted from tick start, so work done in tick doesn't delay next one
+			delta_time = now - last_update_time
+			keys = pressed_keys
+			new_keys = keys & ~previous_keys # just pressed, used for toggles
+			previous_keys = keys
+
+			if keys & KEY_ESCAPE:
 				print('Stopped: Escape pressed')
 				break
 
-			if keyboard.is_pressed('space'):
-				left_motor = 0
-				right_motor = 0
+			if keys & KEY_SPACE:
+				left_motor = left_duty = 0
+				right_motor = right_duty = 0
 				main_light = False
 				other_light = False
 				sendControlUDP()
 				sendControlHTTP()
-				time.sleep(0.200)
+				last_update_time = now
+				wait_for_input(selector, 0.200, keys)
 				continue
 
-			if keyboard.is_pressed('v'):
+			if new_keys & KEY_V:
 				vectorized_mode = not vectorized_mode
 				if vectorized_mode:
 					print('Toggled to vectorized mode')
 				else:
 					print('Toggled to raw mode')
-				time.sleep(0.333)
 
 			gain = base_gain
-			if keyboard.is_modifier('shift'):
+			if keys & KEY_SHIFT:
 				gain *= 2
-			elif keyboard.is_modifier('ctrl'):
+			elif keys & KEY_CTRL:
 				gain /= 4
-			gain *= delta_time
+			# Smoothing scales with time passed, but raw duty uses nominal interval, as ticks woken up by keys change are shorter
+			gain *= delta_time if vectorized_mode else interval
 
-			if keyboard.is_pressed('-'):
-				base_gain -= 0.10 if keyboard.is_pressed('shift') else 0.01
+			if keys & KEY_MINUS:
+				base_gain -= 0.10 if keys & KEY_SHIFT else 0.01
 				print(f'Gain: {base_gain:.3f}')
-			elif keyboard.is_pressed('+') or keyboard.is_pressed('='):
-				base_gain += 0.10 if keyboard.is_pressed('shift') else 0.01
+			elif keys & KEY_PLUS:
+				base_gain += 0.10 if keys & KEY_SHIFT else 0.01
 				print(f'Gain: {base_gain:.3f}')
 
-			if keyboard.is_pressed('['):
-				max_speed -= 0.10 if keyboard.is_pressed('shift') else 0.01
+			if keys & KEY_LEFT_BRACKET:
+				max_speed -= 0.10 if keys & KEY_SHIFT else 0.01
 				max_speed = clamp(max_speed, -1, 1)
 				print(f'Max speed: {max_speed:.3f}')
-			elif keyboard.is_pressed(']'):
-				max_speed += 0.10 if keyboard.is_pressed('shift') else 0.01
+			elif keys & KEY_RIGHT_BRACKET:
+				max_speed += 0.10 if keys & KEY_SHIFT else 0.01
 				max_speed = clamp(max_speed, -1, 1)
 				print(f'Max speed: {max_speed:.3f}')
 
-			if keyboard.is_pressed('f'):
+			if new_keys & KEY_F:
 				main_light = not main_light
-				time.sleep(0.100)
-			if keyboard.is_pressed('r'):
+			if new_keys & KEY_R:
 				other_light = not other_light
-				time.sleep(0.100)
 
 			if vectorized_mode:
+				left_direction = 0.0
+				right_direction = 0.0
+				for movement_keys, (left, right) in MOVEMENT_VECTORS:
+					if keys & movement_keys:
+						left_direction += left
+						right_direction += right
+
 				fade = 1 - gain
-				left_motor *= fade
-				right_motor *= fade
-
-				if keyboard.is_pressed('w') or keyboard.is_pressed('up'):
-					left_motor += gain
-					right_motor += gain
-				if keyboard.is_pressed('a') or keyboard.is_pressed('left'):
-					left_motor -= gain / 2
-					right_motor += gain / 2
-				if keyboard.is_pressed('s') or keyboard.is_pressed('down'):
-					left_motor -= gain
-					right_motor -= gain
-				if keyboard.is_pressed('d') or keyboard.is_pressed('right'):
-					left_motor += gain / 2
-					right_motor -= gain / 2
-
-				if keyboard.is_pressed('q'):
-					left_motor -= gain
-					right_motor += gain
-				if keyboard.is_pressed('e'):
-					left_motor -= gain
-					right_motor += gain
+				left_motor = left_motor * fade + left_direction * gain
+				right_motor = right_motor * fade + right_direction * gain
 			else:
-				left_motor = 0
-				right_motor = 0
-
-				if keyboard.is_pressed('w') or keyboard.is_pressed('up'):
-					left_motor = gain
-					right_motor = gain
-				elif keyboard.is_pressed('a') or keyboard.is_pressed('left'):
-					# left_motor = gain
-					right_motor = gain
-				elif keyboard.is_pressed('s') or keyboard.is_pressed('down'):
-					left_motor = -gain
-					right_motor = -gain
-				elif keyboard.is_pressed('d') or keyboard.is_pressed('right'):
-					left_motor = gain
-					# right_motor = gain
-
-				elif keyboard.is_pressed('q'):
-					left_motor = -gain
-					right_motor = gain
-				elif keyboard.is_pressed('e'):
-					left_motor = gain
-					right_motor = -gain
-
+				left_direction = 0
+				right_direction = 0
+
+				if keys & (KEY_W | KEY_UP):
+					left_direction = 1
+					right_direction = 1
+				elif keys & (KEY_A | KEY_LEFT):
+					# left_direction = 1
+					right_direction = 1
+				elif keys & (KEY_S | KEY_DOWN):
+					left_direction = -1
+					right_direction = -1
+				elif keys & (KEY_D | KEY_RIGHT):
+					left_direction = 1
+					# right_direction = 1
+
+				elif keys & KEY_Q:
+					left_direction = -1
+					right_direction = 1
+				elif keys & KEY_E:
+					left_direction = 1
+					right_direction = -1
+
+				left_motor = left_direction * gain
+				right_motor = right_direction * gain
+
+			# Smoothed values stay uncut, so small steps can accumulate; cut-off applies only to sent duty
 			left_motor = clamp(left_motor, -max_speed, max_speed)
 			right_motor = clamp(right_motor, -max_speed, max_speed)
-			if abs(left_motor) < min_speed:
-				left_motor = 0
-			if abs(right_motor) < min_speed:
-				right_motor = 0
+			left_duty = limit_motor(left_motor, min_speed, max_speed, left_direction)
+			right_duty = limit_motor(right_motor, min_speed, max_speed, right_direction)
 
-			if blink_other_light:
+			if blink_other_light and now - last_blink_time >= blink_interval:
 				other_light = not other_light
+				last_blink_time = now
+
+			# Skip sending the same state again after few ticks, unless keep-alive is due (car stops after timeout)
+			state = (left_duty, right_duty, main_light, other_light)
+			if state != last_sent_state:
+				last_sent_state = state
+				repeat_ticks = STATE_CHANGE_REPEAT_TICKS
+			if repeat_ticks > 0 or now - last_sent_time >= keepalive_interval:
+				sendControlUDP()
+				repeat_ticks = max(repeat_ticks - 1, 0)
+				last_sent_time = now
 
-			sendControlUDP()
-
-			last_update_time = time.time()
-			time.sleep(args.interval / 1000) # milliseconds
+			last_update_time = now
+			wait_for_input(selector, next_tick_time - time.monotonic(), keys)
 
 	except KeyboardInterrupt:
 		print('Stopped: Interrupted by user')
+	finally:
+		if packets_log_thread:
+			packets_log.put(None) # stop after printing packets still queued
+			packets_log_thread.join()
 
 
 
@@ -1,27 +1,31 @@
 Import("env")
 
-import os
 import gzip
-import glob
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 def gzip_file(src, dst):
 	with open(src, 'rb') as src, gzip.open(dst, 'wb') as dst:
-		for chunk in iter(lambda: src.read(4096), b""):
-			dst.write(chunk)
+		shutil.copyfileobj(src, dst, 64 * 1024)
 
-filetypes_to_gzip = ['html', 'js', 'css']
+def gzip_file_if_outdated(source_file_path):
+	target_file_path = source_file_path + '.gz'
+	try:
+		target_mtime = os.stat(target_file_path).st_mtime
+	except FileNotFoundError:
+		target_mtime = -1
+	if os.stat(source_file_path).st_mtime <= target_mtime:
+		return
+	print('Compressing web for embedding: ' + source_file_path)
+	gzip_file(source_file_path, target_file_path)
+
+filetypes_to_gzip = ('.html', '.js', '.css')
 
 src_dir_path = env.get('PROJECT_SRC_DIR')
 
-files_to_gzip = []
-for extension in filetypes_to_gzip:
-	files_to_gzip.extend(glob.glob(os.path.join(src_dir_path, '*.' + extension ) ) )
+with os.scandir(src_dir_path) as entries:
+	files_to_gzip = [entry.path for entry in entries if entry.name.endswith(filetypes_to_gzip) and entry.is_file()]
 
-for source_file_path in files_to_gzip:
-	target_file_path = source_file_path + '.gz'
-	if (os.path.exists(target_file_path)):
-		if (os.path.getmtime(source_file_path) <= os.path.getmtime(target_file_path)):
-			continue
-		os.remove(target_file_path)
-	print('Compressing web for embedding: ' + source_file_path)
-	gzip_file(source_file_path, target_file_path)
+with ThreadPoolExecutor() as executor:
+	list(executor.map(gzip_file_if_outdated, files_to_gzip)) # list to propagate exceptions